@@ -6,10 +6,17 @@
 # So far, only simple Bessel values are calculated.  We will implement
 # integration and arrays of Jnx later, if required
 #
+# besseltable holds a precomputed table of Jn(x) over a range of x, which
+# can be saved to disk and memory mapped so that many processes share one
+# copy.  It has the same interface as bessel, and falls back to the
+# recurrence outside the table.
+#
 # Copyright (c) 2004, Paul Grimes
 #
 # Derived from code by Phichet Kittara
 #
+import os
+import numpy as np
 
 class bessel:
     def __init__(self):
@@ -36,10 +43,46 @@ class bessel:
         # Get Bessel order
         abs_n = abs(n)
         
-        max_n = 50 + 2*abs_n
+        J, norm_factor = self.__recurrence__(abs_n, x)
+        
+        if (n>=0):
+            return J[n]/norm_factor
+        else:
+            return pow(-1, (abs_n%2)+2)*J[abs_n]/norm_factor
+            
+            
+    def Jn_range(self, totalJ, x):
+        """
+        Returns array of Jn(x) for n in -totalJ -> totalJ, all from a single
+        recurrence
+        """
+        totalJ = int(totalJ)
+        result = np.zeros(2*totalJ+1)
+        
+        if (x==0.0):
+            result[totalJ] = 1.0
+            return result
+        
+        J, norm_factor = self.__recurrence__(totalJ, x)
+        
+        Jn = np.array(J[:totalJ+1])/norm_factor
+        sign = np.where(np.arange(totalJ+1)%2 == 0, 1.0, -1.0)
+        result[totalJ:] = Jn
+        result[:totalJ+1] = (sign*Jn)[::-1]
+        
+        return result
+        
+
+    def __recurrence__(self, abs_n, x):
+        """
+        Carries out the reverse recurrence for orders up to at least abs_n.
+        Returns the unnormalised list of J values and the normalisation
+        factor
+        """
+        max_n = 50 + 2*max(abs_n, int(abs(x)))
        
         # Create array for holding the intermediate recurrence results
-        J = range(max_n)
+        J = [0.0]*max_n
         
         # Start the recurrence relation with small values
         J[max_n-1] = 0.0
@@ -64,9 +107,113 @@ class bessel:
         for jj in range(2, max_n, 2):
             norm_factor += 2*J[jj] 
         
-        if (n>=0):
-            return J[n]/norm_factor
-        else:
-            return pow(-1, (abs_n%2)+2)*J[abs_n]/norm_factor
+        return J, norm_factor
 
 
+class besseltable:
+    """
+    Table of Jn(x) for 0 <= n <= maxN on a uniform grid of x, interpolated
+    with order point Lagrange polynomials
+    """
+    def __init__(self, filename=None, maxN=50, xMax=50.0, points=10001, \
+                    order=6):
+        """
+        If filename names an existing table, it is memory mapped read only.
+        Otherwise a table is calculated for x in 0 -> xMax, and saved to
+        filename if given
+        """
+        if (filename is not None) and os.path.exists(filename):
+            self.table = np.load(filename, mmap_mode="r")
+        else:
+            from scipy.special import jv
+            x = np.linspace(0.0, xMax, points)
+            n = np.arange(maxN+1)
+            # Row 0 holds the x grid, row n+1 holds Jn(x)
+            self.table = np.vstack((x, jv(n[:, np.newaxis], x)))
+            if filename is not None:
+                np.save(filename, self.table)
+                self.table = np.load(filename, mmap_mode="r")
+        
+        self.maxN = self.table.shape[0] - 2
+        self.points = self.table.shape[1]
+        self.xMax = float(self.table[0, -1])
+        self.h = self.xMax/(self.points-1)
+        self.order = order
+        
+        # Denominators of the Lagrange weights, prod_(k!=j)(j-k)
+        nodes = np.arange(order)
+        self.__denom__ = np.array([np.prod([j-k for k in nodes if k != j]) \
+                                        for j in nodes], dtype=float)
+        
+        # Engine for values outside of the table
+        self.b = bessel()
+        
+        # Lagrange interpolation error is at most
+        # h^order/order! * max|prod_i(t-i)| * max|Jn^(order)(x)|,
+        # and all derivatives of Jn are bounded by 1
+        t = np.linspace(0.0, order-1.0, 10001)
+        prod = np.ones(len(t))
+        for i in range(order):
+            prod *= (t-i)
+        factorial = np.prod(np.arange(1.0, order+1.0))
+        self.error = self.h**order*np.max(abs(prod))/factorial
+    
+    
+    def save(self, filename):
+        """Saves the table to filename, for memory mapping by other processes"""
+        np.save(filename, np.asarray(self.table))
+    
+    
+    def __weights__(self, x):
+        """
+        Returns first grid index and Lagrange weights of the order point
+        stencil around each x
+        """
+        u = np.asarray(x, dtype=float)/self.h
+        i0 = np.floor(u).astype(int) - (self.order//2 - 1)
+        i0 = np.clip(i0, 0, self.points-self.order)
+        t = u - i0
+        
+        # w_j = prod_(k!=j)(t-k) / prod_(k!=j)(j-k), from products of the
+        # factors to the left and right of j
+        d = t[..., np.newaxis] - np.arange(self.order)
+        left = np.ones(d.shape)
+        left[..., 1:] = np.cumprod(d[..., :-1], axis=-1)
+        right = np.ones(d.shape)
+        right[..., :-1] = np.cumprod(d[..., :0:-1], axis=-1)[..., ::-1]
+        w = left*right/self.__denom__
+        
+        return i0, w
+    
+    
+    def Jnx(self, n, x):
+        """Returns Jn(x), from the table where possible"""
+        n = int(n)
+        abs_n = abs(n)
+        if (abs_n > self.maxN) or (abs(x) > self.xMax):
+            return self.b.Jnx(n, x)
+        
+        # J_n(-x) = J_-n(x) = (-1)^n J_n(x)
+        sign = 1.0
+        if ((n < 0) != (x < 0)) and (abs_n%2 == 1):
+            sign = -1.0
+        
+        i0, w = self.__weights__(abs(x))
+        return sign*float(np.dot(self.table[abs_n+1, i0:i0+self.order], w))
+    
+    
+    def Jn_range(self, totalJ, x):
+        """Returns array of Jn(x) for n in -totalJ -> totalJ"""
+        totalJ = int(totalJ)
+        if (totalJ > self.maxN) or (abs(x) > self.xMax) or (x < 0.0):
+            return self.b.Jn_range(totalJ, x)
+        
+        i0, w = self.__weights__(x)
+        Jn = np.dot(self.table[1:totalJ+2, i0:i0+self.order], w)
+        
+        sign = np.where(np.arange(totalJ+1)%2 == 0, 1.0, -1.0)
+        result = np.empty(2*totalJ+1)
+        result[totalJ:] = Jn
+        result[:totalJ+1] = (sign*Jn)[::-1]
+        
+        return result
@@ -26,4 +26,7 @@ mu0 = 4*pi*1.0e-7
 i = sqrt(-1.0)
 
 # Numerical constants
-DOUBLE_PRECISION = 1.0e-15
\ No newline at end of file
+DOUBLE_PRECISION = 1.0e-15
+
+# Version of the binary format written by save_data methods
+SAVE_VERSION = 1
@@ -8,9 +8,14 @@
 #
 # Derived from code by Phichet Kittara
 #
+import logging
+import threading
+import numpy as np
 import harmonic
 from constants import *
 
+logger = logging.getLogger(__name__)
+
 class frequency:
     """Defines a frequency object that combines a number of harmonics"""
     def __init__(self):
@@ -25,6 +30,9 @@ class frequency:
         self.w_Gap = 1.0  # Junction gap (normalising) frequency
         self.Vph = self.w0/self.w_Gap
         
+        # Shared Bessel function engine, if set by setBessel
+        self.bessel = None
+        
         # Some constants
         self.Delta_Ck = 1.0e-13
         self.Delta_Ck_0 = 1.0e-13
@@ -36,12 +44,14 @@ class frequency:
         self.harmonics = [0, h1]
         
         # Vectors used for storage
-        self.DBCjk = range(self.totalJ*2+1)
-        self.DBC2k = range(self.totalJ*2+1)
-        for Cjk in self.DBCjk:
-            Cjk = complex(0.0)
-        for C2k in self.DBC2k:
-            C2k = complex(0.0)
+        self.DBCjk = np.zeros(self.totalJ*2+1, dtype=complex)
+        self.DBC2k = np.zeros(self.totalJ*2+1, dtype=complex)
+        
+        # Memoized partial spectra C_j, keyed by j.  Each entry holds
+        # (stamps of harmonics 1..j, offset of k=0, array of C_jk).
+        # The lock makes updating them safe from several threads
+        self.__levels__ = {}
+        self.__lock__ = threading.RLock()
             
         # Private variables used for consistency checking
         self.__last_numHarmonics__ = 0
@@ -52,11 +62,10 @@ class frequency:
         self.__last_Vn__ = self.Vn
         self.__last_Vph__ = self.Vph
         
-        # For debug porpoises
-        print "Calling f.__set_Ap__()..."
+        logger.debug("Calling f.__set_Ap__()...")
         self.__set_Ap__()
         
-        print "Calling f.__set_Cjk__()..."
+        logger.debug("Calling f.__set_Cjk__()...")
         self.__set_Cjk__()
         
         
@@ -75,6 +84,8 @@ class frequency:
         self.harmonics.append(harmonic.harmonic(self.totalJ, \
                                 self.getNumHarmonics()+1, Vs, self.w0, \
                                 self.w_Gap))
+        if self.bessel is not None:
+            self.harmonics[-1].use_bessel(self.bessel)
         self.Vs.append(Vs)
         self.Z.append(Z)
         self.Vn.append(complex(1.0))
@@ -101,6 +112,17 @@ class frequency:
         return self.getNumHarmonics()
     
         
+    def setBessel(self, b):
+        """
+        Sets the Bessel function engine used by all harmonics, including
+        those added later.  A single bessel.besseltable can be shared by
+        many frequencies
+        """
+        self.bessel = b
+        for h in self.harmonics[1:]:
+            h.use_bessel(b)
+            
+            
     def getNumBessel(self):
         """Returns number of Bessel coefficients per harmonic"""
         return self.totalJ
@@ -111,7 +133,7 @@ class frequency:
         cause any recalculation within the harmonics, as this will be done
         automatically when harmonic.get_Anp(n) is called
         """
-        for h in harmonics:
+        for h in self.harmonics[1:]:
             h.totalJ = totalJ
         
         self.totalJ = totalJ    
@@ -173,15 +195,41 @@ class frequency:
     
     
     def Cjk(self, j, k):
-        """Returns value of Cjk"""
+        """
+        Returns value of Cjk.  Only the partial spectra C_1..C_j are
+        evaluated, and each is cached until one of its harmonics changes
+        """
         return self.__get_each_Cjk__(j,k)
         
         
+    def getCk(self):
+        """
+        Returns array of Ck for k in -totalJ -> totalJ.  Safe to call from
+        several threads at once
+        """
+        with self.__lock__:
+            offset, C = self.__get_level__(self.getNumHarmonics())
+            return C[offset-self.totalJ:offset+self.totalJ+1].copy()
+            
+            
+    def __getstate__(self):
+        """Returns state for pickling, less the unpicklable lock"""
+        state = self.__dict__.copy()
+        del state["__lock__"]
+        return state
+        
+        
+    def __setstate__(self, state):
+        """Restores pickled state, with a new lock"""
+        self.__dict__.update(state)
+        self.__lock__ = threading.RLock()
+        
+        
     def Ck(self, k):
         """Returns value of Cjk"""
         result = complex(0.0)
         if (abs(k) <= self.totalJ):
-            result = self.DBCjk[k+self.totalJ]
+            result = self.__get_each_Cjk__(self.getNumHarmonics(), k)
         
         return result
         
@@ -215,9 +263,145 @@ class frequency:
         
         
         
+    def pumpedIV(self, responseFn, bias, pumps=None, quadrature=False):
+        """
+        Calculates the pumped DC IV curve sum_k |Ck|^2 * Idc(x + k*Vph) for
+        each bias x in the array bias.  1st argument is a response function
+        object.
+        pumps is an optional sequence of values of Vn[1] (the LO drive); if
+        given the result has one row per pump level, otherwise the current
+        Vn is used.  If quadrature is True, the KK (quadrature) current
+        sum_k |Ck|^2 * Ikk(x + k*Vph) is also returned.
+        totalJ is raised as needed for each pump level, and restored after
+        """
+        bias = np.asarray(bias, dtype=float)
+        
+        # |Ck|^2 for each pump level, each over its own range of k
+        if pumps is None:
+            Ck2 = [self.__pumped_Ck2__()]
+        else:
+            Vn1 = self.Vn[1]
+            Ck2 = []
+            try:
+                for pump in pumps:
+                    self.Vn[1] = complex(pump)
+                    Ck2.append(self.__pumped_Ck2__())
+            finally:
+                self.Vn[1] = Vn1
+                
+        # Pad all pump levels to a common range of k
+        K = max([(len(row)-1)//2 for row in Ck2])
+        k = np.arange(-K, K+1)
+        Ck2 = np.array([np.pad(row, K-(len(row)-1)//2) for row in Ck2])
+        if pumps is None:
+            Ck2 = Ck2[0]
+            
+        # Response function at every bias and photon step
+        V = bias[..., np.newaxis] + k*self.Vph
+        Idc = np.dot(responseFn.IdcArray(V), Ck2.T)
+        if pumps is not None:
+            Idc = np.moveaxis(Idc, -1, 0)
+            
+        if not quadrature:
+            return Idc
+            
+        Ikk = np.dot(responseFn.IkkArray(V), Ck2.T)
+        if pumps is not None:
+            Ikk = np.moveaxis(Ikk, -1, 0)
+            
+        return Idc, Ikk
+        
+        
+    def __pumped_Ck2__(self):
+        """
+        Private method returning |Ck|^2 for the current Vn, for k in
+        -J -> J.  J is raised from totalJ until the spectrum covers the
+        drive, i.e. until sum |Ck|^2 is within Delta_Ck_0 of 1.  totalJ is
+        restored afterwards
+        """
+        # The spectrum of harmonic p spreads over about its drive level
+        # alpha = |Vn[p]|/(p*Vph) photon steps
+        alpha = sum([abs(self.Vn[p])/(p*self.Vph) \
+                        for p in range(1, self.getNumHarmonics()+1)])
+        start = self.totalJ
+        J = max(start, int(np.ceil(alpha)) + 10)
+        
+        try:
+            while True:
+                self.setNumBessel(J)
+                Ck2 = abs(self.getCk())**2
+                Delta = abs(np.sum(Ck2)-1.0)
+                if (Delta <= self.Delta_Ck_0) or (J >= start+int(alpha)+60):
+                    break
+                J += 5
+        finally:
+            self.setNumBessel(start)
+            
+        if (Delta > 1.0e-6):
+            logger.warning("Pumped spectrum truncated at totalJ = %d: " \
+                            "sum |Ck|^2 = %g", J, np.sum(Ck2))
+            
+        return Ck2
+        
+        
     def save_data(self, f):
-        """Writes frequency data out to file object f"""
-        pass
+        """
+        Writes frequency data out to file object (or filename) f, in numpy
+        .npz format.  Anp values are saved so load_data need not
+        recalculate them
+        """
+        np.savez(f, version=SAVE_VERSION, **self.__get_arrays__())
+        
+        
+    def load_data(self, f):
+        """Reads frequency data written by save_data from file object f"""
+        with np.load(f) as data:
+            if int(data["version"]) != SAVE_VERSION:
+                raise ValueError("Unsupported save_data version %d" \
+                                    % int(data["version"]))
+            self.__set_arrays__(data)
+        
+        
+    def __get_arrays__(self):
+        """Private method returning dict of arrays describing the state"""
+        return {"totalJ" : self.totalJ,
+                "w0" : self.w0,
+                "w_Gap" : self.w_Gap,
+                "Delta_Ck" : self.Delta_Ck,
+                "Vs" : np.array(self.Vs, dtype=complex),
+                "Z" : np.array(self.Z, dtype=complex),
+                "Vn" : np.array(self.Vn, dtype=complex),
+                "Vp" : np.array([h.Vp for h in self.harmonics[1:]], \
+                                    dtype=complex),
+                "Anp" : np.array([h.Anp for h in self.harmonics[1:]]),
+                "DBCjk" : self.DBCjk,
+                "DBC2k" : self.DBC2k}
+                
+                
+    def __set_arrays__(self, state, prefix=""):
+        """
+        Private method restoring the state from a dict of arrays, with keys
+        optionally prefixed by prefix
+        """
+        self.totalJ = int(state[prefix+"totalJ"])
+        self.w0 = float(state[prefix+"w0"])
+        self.w_Gap = float(state[prefix+"w_Gap"])
+        self.Vph = self.w0/self.w_Gap
+        self.Delta_Ck = float(state[prefix+"Delta_Ck"])
+        self.Vs = [complex(v) for v in state[prefix+"Vs"]]
+        self.Z = [complex(z) for z in state[prefix+"Z"]]
+        self.Vn = [complex(v) for v in state[prefix+"Vn"]]
+        self.DBCjk = np.array(state[prefix+"DBCjk"])
+        self.DBC2k = np.array(state[prefix+"DBC2k"])
+        
+        self.harmonics = [0]
+        for p, (Vp, Anp) in enumerate(zip(state[prefix+"Vp"], \
+                                        state[prefix+"Anp"])):
+            self.harmonics.append(harmonic.harmonic(self.totalJ, p+1, \
+                    complex(Vp), self.w0, self.w_Gap, Anp=Anp))
+            if self.bessel is not None:
+                self.harmonics[-1].b = self.bessel
+        self.__levels__ = {}
         
         
     def __set_Cjk__(self):
@@ -226,43 +410,26 @@ class frequency:
             return 0
         
         # Get Cjk
-        for k in range(-self.totalJ, self.totalJ+1):
-            self.DBCjk[k+self.totalJ] = \
-                self.__get_each_Cjk__(self.getNumHarmonics(), k)
+        self.DBCjk = self.getCk()
                 
         # check accuracy
-        sum = complex(0.0)
-        for k in range(-self.totalJ, self.totalJ+1):
-            sum += self.DBCjk[k+self.totalJ] \
-                    * self.DBCjk[k+self.totalJ].conjugate()
-            sum += self.DBCjk[k+self.totalJ].conjugate() \
-                    * self.DBCjk[k+self.totalJ]
-                   
-        sum *= 0.5
+        sum = np.sum(abs(self.DBCjk)**2)
         
         self.Delta_Ck = abs(sum-1.0)
         
         # Accurate enough
         if (self.Delta_Ck > self.Delta_Ck_0) and (self.totalJ < 50):
             self.totalJ += 5
-            self.DBCjk = range(self.totalJ*2+1) # magic to get list of right
-            self.DBC2k = range(self.totalJ*2+1) # length and type
-            for Cjk in self.DBCjk:
-                Cjk = complex(0.0)
-            for C2k in self.DBC2k:
-                C2k = complex(0.0) # end of magic
+            self.DBCjk = np.zeros(self.totalJ*2+1, dtype=complex)
+            self.DBC2k = np.zeros(self.totalJ*2+1, dtype=complex)
             self.__set_Ap__()
             self.__set_Cjk__()
             
         # Too accurate
         if (self.Delta_Ck < 1.0e-5*self.Delta_Ck_0) and (self.totalJ > 15):
             self.totalJ -= 2
-            self.DBCjk = range(self.totalJ*2+1) # magic to get list of right
-            self.DBC2k = range(self.totalJ*2+1) # length and type
-            for Cjk in self.DBCjk:
-                Cjk = complex(0.0)
-            for C2k in self.DBC2k:
-                C2k = complex(0.0) # end of magic
+            self.DBCjk = np.zeros(self.totalJ*2+1, dtype=complex)
+            self.DBC2k = np.zeros(self.totalJ*2+1, dtype=complex)
             self.__set_Ap__()
             self.__set_Cjk__()
             
@@ -270,19 +437,8 @@ class frequency:
         
     def __set_C2k__(self):
         """Private method to set C2k values"""
-        #if self.checkValid():
-        #    return 0
-        
-        for k in range(-self.totalJ, self.totalJ+1):
-            temp = complex(0.0)
-            for m in range(-self.totalJ, self.totalJ+1):
-                # This bit goes very wrong as k-2m runs from 10->-30
-                # then 11->-29, which overflows h.Anp[k-2m]
-                # Missing check on value of int passed to h.get_Anp
-                temp +=self.harmonics[1].get_Anp(k-2*m) \
-                     * self.harmonics[2].get_Anp(m)
-                        
-            self.DBC2k[k+self.totalJ] = temp
+        offset, C = self.__get_level__(2)
+        self.DBC2k = C.copy()
             
         
         
@@ -291,34 +447,80 @@ class frequency:
         if self.checkValid():
             return 0
         
-        for p in range(1, self.getNumHarmonics()):
-            self.harmonics[p].totalJ = self.totalJ
-            self.harmonics[p].p = p
-            self.harmonics[p].Vp = self.Vn[p]
-            self.harmonics[p].w0 = self.w0
-            self.harmonics[p].w_Gap = self.w_Gap
-            self.harmonics[p].Anp = range(self.totalJ*2 + 1)
-            self.harmonics[p].calc_Anp()
+        for p in range(1, self.getNumHarmonics()+1):
+            self.__set_harmonic__(p)
             
         if (self.getNumHarmonics() > 1 ):
             self.__set_C2k__()
             
+            
+    def __set_harmonic__(self, p):
+        """
+        Private method to bring harmonic p up to date with the frequency.
+        Anp values are only recalculated if something has changed
+        """
+        h = self.harmonics[p]
+        h.totalJ = self.totalJ
+        h.p = p
+        h.Vp = self.Vn[p]
+        h.w0 = self.w0
+        h.w_Gap = self.w_Gap
+        if not h.valid():
+            h.calc_Anp()
+            
+        return h
+        
+        
+    def __get_level__(self, j):
+        """
+        Private method returning (offset, C) for the partial spectrum C_j,
+        where C[k+offset] = Cjk.  Levels are calculated on first use and
+        recalculated only when one of harmonics 1..j has changed
+        """
+        with self.__lock__:
+            return self.__calc_level__(j)
+            
+            
+    def __calc_level__(self, j):
+        """Private method doing the work of __get_level__, under its lock"""
+        if ( j<=0 ) or ( j > self.getNumHarmonics()):
+            raise IndexError("Requested non-existant harmonic")
+            
+        stamps = tuple([self.__set_harmonic__(p).stamp \
+                            for p in range(1, j+1)])
+        
+        cached = self.__levels__.get(j)
+        if (cached is not None) and (cached[0] == stamps):
+            return cached[1], cached[2]
+            
+        A = self.harmonics[j].Anp
+        
+        if ( j==1 ):
+            offset = self.totalJ
+            C = A.copy()
+        else:
+            # C_jk = sum_m C_(j-1)(k-jm) * A_jm is a convolution of C_(j-1)
+            # with A_j spread onto every j'th k
+            last_offset, last_C = self.__get_level__(j-1)
+            Aj = np.zeros(2*j*self.totalJ+1, dtype=complex)
+            Aj[::j] = A
+            offset = last_offset + j*self.totalJ
+            C = np.convolve(last_C, Aj)
+            
+            # C2k is only kept for -totalJ -> totalJ
+            if ( j==2 ):
+                C = C[offset-self.totalJ:offset+self.totalJ+1]
+                offset = self.totalJ
+                
+        self.__levels__[j] = (stamps, offset, C)
+        return offset, C
+            
         
     def __get_each_Cjk__(self, j, k):
         """Private method to return individual Cjk values"""
-        result = complex(0.0)
-        if ( j<=0 ) or ( j > self.getNumHarmonics()):
-            raise IndexError, "Requested non-existant harmonic"
-        elif ( j==1 ):
-            result = self.harmonics[j].get_Anp(k)
-        elif ( j==2 ):
-            if (abs(k) <= self.totalJ):
-                result = self.DBC2k[k + self.totalJ]
-        
-        else: # j >=3, Only want to run this if harmonics exist
-            for m in range(-self.totalJ, self.totalJ+1):
-                result += self.__get_each_Cjk__(j-1, k-j*m) \
-                            * self.harmonics[j].get_Anp(m)
-
-        return result 
+        offset, C = self.__get_level__(j)
+        if (k+offset < 0) or (k+offset >= len(C)):
+            return complex(0.0)
+        
+        return complex(C[k+offset])
         
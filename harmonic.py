@@ -4,15 +4,16 @@
 # Defines a class holding the properties of a single harmonic
 #
 # Class contains:
-#    bessel b     : object for calculating bessel functions.  This is a very
-#                    inefficient idea, as each harmonic will have it's own
-#                    bessel engine.
-#    list Anp     : list of Anp coefficients
+#    bessel b     : object for calculating bessel functions.  Each harmonic
+#                    has its own bessel engine unless a shared
+#                    bessel.besseltable is set with use_bessel()
+#    array Anp    : array of Anp coefficients
 #    int p        : order of harmonic
 #    int totalJ   : number of Anp coefficients to calculate
 #    complex Cvp  : Cvp coefficient of this class
 #    double w_0  : angular frequency of harmonics fundamental
 #    double w_Gap : angular frequency of junction gap (normalising frequency)
+#    int stamp    : unique value identifying the current Anp calculation
 #    calc_Anp()   : method to cause recalculation of Anp coefficients
 #    get_Anp()    : method to retrieve value of Anp coefficient
 #
@@ -20,11 +21,16 @@
 #
 # Derived from code by Phichet Kittara
 #
+import itertools
+import numpy as np
 import bessel
 
+# Source of unique stamps identifying each calculation of Anp
+__stamps__ = itertools.count()
+
 class harmonic:
     """Class keeping all information about a single harmonic"""
-    def __init__(self, totalJ, p, Vp, w0, w_Gap):
+    def __init__(self, totalJ, p, Vp, w0, w_Gap, Anp=None):
         """
         Constructor takes five values:
             totalJ : int number of Anp coefficients
@@ -32,6 +38,8 @@ class harmonic:
             Vp : complex coefficient Vp
             w_0 : double angular frequency of fundamental (harmonic where p=0)
             w_Gap : normalising angular frequency
+        and optionally Anp, previously calculated Anp values for this state,
+        which are then used without recalculation
         """
         self.totalJ = totalJ
         self.p = p
@@ -39,11 +47,14 @@ class harmonic:
         self.w0 = w0
         self.w_Gap = w_Gap
         
-        self.Anp = range(totalJ*2 + 1)
+        self.Anp = np.zeros(totalJ*2 + 1, dtype=complex)
         self.b = bessel.bessel()
         
         # Must do this last        
-        self.calc_Anp()
+        if Anp is None:
+            self.calc_Anp()
+        else:
+            self.set_Anp(Anp)
 
         
     def calc_Anp(self):
@@ -57,8 +68,8 @@ class harmonic:
         self.__last_w0__ = self.w0
         self.__last_w_Gap__ = self.w_Gap
         
-        # Set length of Anp
-        self.Anp = range(self.totalJ*2 + 1)
+        # Anp will change, so anything derived from them is now stale
+        self.stamp = next(__stamps__)
         
         # Get magnitude of voltage
         V = abs(self.Vp)
@@ -72,15 +83,34 @@ class harmonic:
         else:
             unitV = complex(1.0,0.0)
         
-        real_unitV = pow(unitV.conjugate(), -self.totalJ)
-        
-        for i in range(-self.totalJ, self.totalJ+1):
-            self.Anp[i+self.totalJ] = self.b.Jnx(i, alpha)
-            self.Anp[i+self.totalJ] *= real_unitV
-            # real_unitV *= unitV.conjugate()
-            # self.Anp[i+totalJ] = pow(unitV.conjugate(), i)
+        # Anp = Jn(alpha)*conj(unitV)^n, for all n from one recurrence or
+        # table lookup
+        n = np.arange(-self.totalJ, self.totalJ+1)
+        self.Anp = self.b.Jn_range(self.totalJ, alpha) \
+                        * unitV.conjugate()**n
             
             
+    def use_bessel(self, b):
+        """
+        Sets the Bessel function engine, e.g. a bessel.besseltable shared
+        between harmonics, and recalculates Anp
+        """
+        self.b = b
+        self.calc_Anp()
+        
+        
+    def set_Anp(self, Anp):
+        """Store previously calculated Anp values for the current state"""
+        self.stamp = next(__stamps__)
+        self.__last_totalJ__ = self.totalJ
+        self.__last_p__ = self.p
+        self.__last_Vp__ = self.Vp
+        self.__last_w0__ = self.w0
+        self.__last_w_Gap__ = self.w_Gap
+        
+        self.Anp = np.array(Anp, dtype=complex)
+        
+        
     def get_Anp(self, n):
         """Returns value of Anp, given integer n in range
         -totalJ -> totalJ.  Only recalculates Anp if state has changed"""
@@ -1,111 +1,285 @@
 # harmonicnewton.py
 #------------------------
 #
-# defines a hermonic balancer class 
+# defines a hermonic balancer class
+#
+# With krylov set, each Newton step is found by GMRES using finite
+# difference products of the residual with the search direction, so the
+# Jacobian is never formed.  The GMRES iteration can be preconditioned with
+# the inverse of the blockSize x blockSize diagonal blocks of the Jacobian,
+# which cost blockSize residual evaluations to estimate.  If GMRES does not
+# converge, its last iterate is used as an inexact Newton step, damped by
+# the line search.
+#
+# With lineSearch set, the Newton step is damped by backtracking until the
+# residual norm decreases sufficiently, rather than taking the full step and
+# resetting large components.
 #
 # Copyright (c) 2004, Paul Grimes
 #
 # Derived from code by Phichet Kittara
 #
-from numarray import *
-import numarray.linear_algebra as linear_algebra
+import numpy as np
+import numpy.linalg as linear_algebra
+import scipy.sparse.linalg as sparse_linalg
 
 class harmonicnewton:
     """Object that balances harmonics"""
-    def __init__(self, HSize):
-        """Constructs harmonicnewton object for HSize harmonics"""
-        self.StopCheck = FALSE
-        
+    def __init__(self, HSize, function=None):
+        """
+        Constructs harmonicnewton object for HSize unknowns.
+        function(x) must return the residual vector at x, e.g.
+        multitone.__Delta__
+        """
+        self.StopCheck = False
+
         self.HarmonicSize = HSize
-        
+        self.function = function
+
         # This needs to start out as the unit matrix
-        self.Jacobian = identity(self.HarmonicSize, type=Complex)
-        
-        self.OldX = zeros(self.HarmonicSize, type=Complex)
-        self.NewX = zeros(self.HarmonicSize, type=Complex)
-        self.OldY = zeros(self.HarmonicSize, type=Complex)
-        self.DeltaX = zeros(self.HarmonicSize, type=Complex)
-        
-        self.MIN_X = 1.0e-30
+        self.Jacobian = np.identity(self.HarmonicSize)
+
+        self.OldX = np.zeros(self.HarmonicSize)
+        self.NewX = np.zeros(self.HarmonicSize)
+        self.OldY = np.zeros(self.HarmonicSize)
+        self.DeltaX = np.zeros(self.HarmonicSize)
+
+        self.MIN_X = 1.0e-8
         self.MAX_X = 1.0e1
         self.stepFactor = 1.0e-3
-        
-        
+
+        # Jacobian-free Newton-Krylov settings
+        self.krylov = False
+        self.krylovTol = 1.0e-4 # relative tolerance of each linear solve
+        self.krylovMaxIt = 100
+        self.precondition = True
+        self.blockSize = 2      # e.g. real and imaginary parts of one Vn
+        self.Preconditioner = None
+
+        # Damped Newton settings
+        self.lineSearch = False
+        self.alpha = 1.0e-4     # sufficient decrease factor
+        self.minStep = 1.0e-4   # smallest fraction of the Newton step tried
+        self.ftol = 0.0         # converged if residual norm <= ftol
+
+        # Statistics of the last call to Newton
+        self.iterations = 0
+        self.fevals = 0
+        self.krylovFailures = 0
+        self.reason = ""
+        self.NewY = None
+
+        # Point of the last residual evaluation
+        self.__lastX__ = None
+
+
     def clear(self):
         """Clears stored data"""
-        self.OldX = zeros(self.HarmonicSize, type=Complex)
-        self.NewX = zeros(self.HarmonicSize, type=Complex)
-        self.OldY = zeros(self.HarmonicSize, type=Complex)
-        self.DeltaX = zeros(self.HarmonicSize, type=Complex)
-        
+        self.OldX = np.zeros(self.HarmonicSize)
+        self.NewX = np.zeros(self.HarmonicSize)
+        self.OldY = np.zeros(self.HarmonicSize)
+        self.DeltaX = np.zeros(self.HarmonicSize)
+
         # This actually needs to be the unit matrix
-        self.Jacobian = identity(self.HarmonicSize, type=Complex)
-            
-        
+        self.Jacobian = np.identity(self.HarmonicSize)
+        self.Preconditioner = None
+
+
     def setX(self, initX):
         """Set old and new x arrays to initX"""
-        self.OldX = initX
-        self.NewX = initX
-        
-        
+        self.OldX = np.array(initX, dtype=float)
+        self.NewX = np.array(initX, dtype=float)
+
+
     def setJacobian(self):
-        """Calculate Jacobian"""
-        TempX = zeros(self.HarmonicSize, type=Complex)
-        TempY = zeros(self.HarmonicSize, type=Complex)
-        
-        for h in range(self.HarmonicSize):
-            TempX = self.OldX
-            
-            dX = self.StepFactor*abs(self.OldX[i])
-            
+        """Calculate Jacobian by forward differences about OldX"""
+        for i in range(self.HarmonicSize):
+            TempX = self.OldX.copy()
+
+            dX = self.stepFactor*abs(self.OldX[i])
+
             if (dX < self.MIN_X):
-                dX = MIN_X
-                
+                dX = self.MIN_X
+
             TempX[i] += dX
-            FUNCTIONEVALUATION(TempX, TempY)
-            
-            for j in range(HarmonicSize):
-                dY = TempY[j]-OldY[j]
-                self.Jacobian[j][i] = dY/dX
-                
-                
+            TempY = self.__evaluate__(TempX)
+
+            self.Jacobian[:, i] = (TempY-self.OldY)/dX
+
+
+    def __evaluate__(self, x):
+        """Evaluate the residual function at x, counting evaluations"""
+        self.fevals += 1
+        self.__lastX__ = np.array(x, dtype=float)
+        return self.function(x)
+
+
+    def setPreconditioner(self):
+        """
+        Estimate the diagonal blocks of the Jacobian about OldX and store
+        their inverses.  Perturbing the same element of every block at once
+        gives each block's column with blockSize residual evaluations,
+        neglecting coupling between blocks
+        """
+        nb = self.HarmonicSize//self.blockSize
+        size = nb*self.blockSize
+        blocks = np.zeros((nb, self.blockSize, self.blockSize))
+
+        for c in range(self.blockSize):
+            TempX = self.OldX.copy()
+
+            dX = self.stepFactor*abs(self.OldX[c:size:self.blockSize])
+            dX = np.maximum(dX, self.MIN_X)
+
+            TempX[c:size:self.blockSize] += dX
+            dY = self.__evaluate__(TempX)-self.OldY
+
+            blocks[:, :, c] = dY[:size].reshape(nb, self.blockSize) \
+                                    / dX[:, np.newaxis]
+
+        self.Preconditioner = linear_algebra.inv(blocks)
+
+
+    def __precondition__(self, v):
+        """Apply the inverse block diagonal preconditioner to v"""
+        nb = len(self.Preconditioner)
+        size = nb*self.blockSize
+        result = np.array(v, dtype=float)
+        result[:size] = np.einsum("bij,bj->bi", self.Preconditioner, \
+                            result[:size].reshape(nb, self.blockSize)).ravel()
+        return result
+
+
+    def __Jv__(self, v):
+        """Finite difference product of the Jacobian at OldX with v"""
+        norm_v = linear_algebra.norm(v)
+        if (norm_v == 0.0):
+            return np.zeros(self.HarmonicSize)
+
+        eps = np.sqrt(np.finfo(float).eps) \
+                * (1.0+linear_algebra.norm(self.OldX))/norm_v
+
+        return (self.__evaluate__(self.OldX+eps*v)-self.OldY)/eps
+
+
     def setNewX(self):
         """Calculate new X values"""
-        
-        Jacobian = linear_algebra.inverse(self.Jacobian)
-        
-        self.DeltaX = matrixmultiply(Jacobian, self.OldY)
-        
+
+        if self.krylov:
+            J = sparse_linalg.LinearOperator( \
+                    (self.HarmonicSize, self.HarmonicSize), \
+                    matvec=self.__Jv__, dtype=float)
+            M = None
+            if self.Preconditioner is not None:
+                M = sparse_linalg.LinearOperator( \
+                    (self.HarmonicSize, self.HarmonicSize), \
+                    matvec=self.__precondition__, dtype=float)
+            self.DeltaX, info = sparse_linalg.gmres(J, self.OldY, \
+                    rtol=self.krylovTol, maxiter=self.krylovMaxIt, M=M)
+            if (info != 0):
+                # GMRES did not reach krylovTol, so its iterate is only an
+                # inexact step; always damp it by line search
+                self.krylovFailures += 1
+                return self.setLineSearchX()
+        else:
+            self.DeltaX = linear_algebra.solve(self.Jacobian, self.OldY)
+
+        if self.lineSearch:
+            return self.setLineSearchX()
+
         self.NewX = self.OldX-self.DeltaX
-        
-        for h in range(self.HarmonicSize)
-            if self.NewX > self.MAX_X:
-                NewX[i] = complex(1.0)
-
-                
-    def Newton(self, max_it, tol)
-        """Carry out the Harmonic Newton minimisation"""
-        
-        totalCheck = TRUE
-        diff = 0.0
-        
+        self.NewY = None
+
+        self.NewX[abs(self.NewX) > self.MAX_X] = 1.0
+
+        return True
+
+
+    def setLineSearchX(self):
+        """
+        Calculate new X values by backtracking along the Newton step until
+        the residual norm satisfies the sufficient decrease condition.
+        Returns False if no acceptable step larger than minStep was found,
+        leaving NewX and NewY at OldX and OldY
+        """
+        norm0 = linear_algebra.norm(self.OldY)
+        step = 1.0
+
+        while True:
+            self.NewX = self.OldX-step*self.DeltaX
+            self.NewY = self.__evaluate__(self.NewX)
+            norm = linear_algebra.norm(self.NewY)
+
+            if (norm <= (1.0-self.alpha*step)*norm0):
+                return True
+            if (step <= self.minStep):
+                # Every trial point was worse, so stay where we were
+                self.NewX = self.OldX.copy()
+                self.NewY = self.OldY
+                return False
+
+            # Minimise the quadratic model of f = |F|^2/2 through f at 0 and
+            # step, with slope -2f at 0 along the Newton step, keeping the
+            # new step within [step/10, step/2]
+            f0 = norm0*norm0
+            trial = step*step*f0/(norm*norm+(2.0*step-1.0)*f0)
+            step = min(max(trial, 0.1*step), 0.5*step)
+
+
+    def Newton(self, max_it, tol):
+        """
+        Carry out the Harmonic Newton minimisation.
+        Returns the number of iterations used.  The number of iterations,
+        number of function evaluations and reason for stopping ("step",
+        "residual", "max_it" or "line search") are kept in iterations,
+        fevals and reason.  The residual function is last evaluated at the
+        final NewX, so a model it updates is left at the solution.
+        krylovFailures counts the steps for which GMRES did not converge,
+        and its iterate was damped by line search
+        """
+        self.fevals = 0
+        self.krylovFailures = 0
+        self.reason = "max_it"
+
         count = 0
-        
-        while( (count < max_it) and totalCheck):
-            self.OldX = self.NewX
-            #FUNCTIONEVALUATION(self.OldX, self.OldY)
-            
-            self.setJacobian()
-            self.setNewX()
-            
-            totalCheck = FALSE
-            for h in range(self.HarmonicSize):
-                diff = abs(self.NewX[i]-self.OldX[i])
-                if (diff > epsilon*fabs(OldX[i]):
-                    totalCheck = TRUE
-                    break
-                    
-            count++
-                     
+
+        self.OldX = self.NewX.copy()
+        self.OldY = self.__evaluate__(self.OldX)
+
+        while (count < max_it):
+            if (linear_algebra.norm(self.OldY) <= self.ftol):
+                self.NewX = self.OldX.copy()
+                self.reason = "residual"
+                break
+
+            if not self.krylov:
+                self.setJacobian()
+            elif self.precondition:
+                self.setPreconditioner()
+            accepted = self.setNewX()
+
+            count += 1
+
+            if not accepted:
+                self.reason = "line search"
+                break
+
+            diff = linear_algebra.norm(self.NewX-self.OldX)
+            if (diff <= tol*linear_algebra.norm(self.OldX)):
+                self.reason = "step"
+                break
+
+            self.OldX = self.NewX.copy()
+            if self.NewY is None:
+                self.OldY = self.__evaluate__(self.OldX)
+            else:
+                self.OldY = self.NewY
+
+        self.iterations = count
+
+        # The last evaluation may have been a finite difference or rejected
+        # trial point
+        if not np.array_equal(self.__lastX__, self.NewX):
+            self.NewY = self.__evaluate__(self.NewX)
+
         return count
-            
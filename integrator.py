@@ -4,10 +4,15 @@
 # Defines an integrator for calculating KK transforms
 # Uses technique from Numerical Recipes
 #
+# If vectorized is set, the integrand is called once per refinement with a
+# numpy array of abscissae rather than once per point
+#
 # Copyright (c) 2004, Paul Grimes
 #
 # Derived from code by Phichet Kittara
 #
+import numpy as np
+
 class integrator:
     """Defines a integrator class for use in calculating KK transforms"""
     def __init__(self):
@@ -16,6 +21,7 @@ class integrator:
         self.__jMin__ = 5
         self.__eps__ = 1.0e-5
         self.s = 0.0
+        self.vectorized = False
         
         
     def integrate(self, integrand, low, high):
@@ -71,9 +77,12 @@ class integrator:
              x = low+0.5*delta
              sum = 0.0
              
-             for j in range(iteration):
-                 sum += integrand(x)
-                 x += delta
+             if self.vectorized:
+                 sum = np.sum(integrand(x + delta*np.arange(iteration)))
+             else:
+                 for j in range(iteration):
+                     sum += integrand(x)
+                     x += delta
                  
              s = 0.5*(self.s+(high-low)*sum/tnm)
              
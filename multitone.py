@@ -11,18 +11,73 @@
 # Developed from algortihms and C++ code by Phichet Kittara
 #
 # Updated 2016, Paul Grimes, Smithsonian Astrophysical Observatory
+#
+# A series array of numJunctions identical junctions is modelled through
+# its symmetry: every junction carries the same current and has the same
+# voltage Vn, so the array is solved for a single junction's Vn, with the
+# array voltage numJunctions*Vn in the embedding circuit.  All junctions
+# share one response function and one set of frequency objects.
 
+from concurrent.futures import ThreadPoolExecutor
 import scipy.constants as constants
 import numpy as np
 import numpy.linalg as la
-import numpy.convolve as conv
+import frequency, responseFn, harmonicnewton
+from constants import SAVE_VERSION
+
+class OneCk(object):
+    """
+    Spectral coefficient and corresponding frequency.  OneCk objects are
+    views onto a single line of a spectrum; setting freq or Amp writes
+    through to the spectrum arrays
+    """
+    __slots__ = ("spectrum", "n")
+    
+    def __init__(self, spectrum=None, n=0):
+        if spectrum is None:
+            spectrum = ckspectrum([1.0], [complex(1.0)])
+        self.spectrum = spectrum
+        self.n = n
+        
+    def __get_freq__(self):
+        return self.spectrum.freq[self.n]
+        
+    def __set_freq__(self, freq):
+        self.spectrum.freq[self.n] = freq
+        
+    def __get_Amp__(self):
+        return self.spectrum.Amp[self.n]
+        
+    def __set_Amp__(self, Amp):
+        self.spectrum.Amp[self.n] = Amp
+        
+    freq = property(__get_freq__, __set_freq__)
+    Amp = property(__get_Amp__, __set_Amp__)
 
-class OneCk:
-    """Object holding spectral coefficient and corresponding frequency"""
-    def __init__(self):
-        self.freq = 1.0
-        self.Amp = complex(1.0)
 
+class ckspectrum(object):
+    """
+    Ck spectrum held as contiguous arrays of frequencies (float64) and
+    amplitudes (complex128).  Indexing and iteration return OneCk views, so
+    that code written against a list of OneCk objects keeps working
+    """
+    __slots__ = ("freq", "Amp")
+    
+    def __init__(self, freq=(), Amp=()):
+        self.freq = np.array(freq, dtype=np.float64)
+        self.Amp = np.array(Amp, dtype=np.complex128)
+        
+    def __len__(self):
+        return len(self.freq)
+        
+    def __getitem__(self, n):
+        if (n < -len(self.freq)) or (n >= len(self.freq)):
+            raise IndexError("Spectrum index out of range")
+        return OneCk(self, n % len(self.freq))
+        
+    def __iter__(self):
+        for n in range(len(self.freq)):
+            yield OneCk(self, n)
 
         
 class multitone:
@@ -30,101 +85,417 @@ class multitone:
     def __init__(self):
         """Constructor.  Defines members of multitone object"""
         
-        # list of all frequencies
-        self.freqs = []
+        # list of all frequencies.  As with frequency.harmonics, freqs[0]
+        # is a placeholder so that the first frequency is freqs[1]
+        self.freqs = [0]
         
-        # list of frequencies with Z != 0
+        # frequency and harmonic indices of harmonics with Z != 0
         self.freqsToSolve = []
+        self.harmsToSolve = []
+        self.HarmonicSize = 0
+        
+        # response function and normalised bias voltage of the junction,
+        # or of the whole array if numJunctions > 1
+        self.response = None
+        self.bias = 0.0
+        
+        # number of identical junctions in series
+        self.numJunctions = 1
         
         # minimum Ck value to be kept
         self.min_Ck = 1.0e-18
         
-        # Ck spectrum (list of OneCk objects)
-        self.Ck = []
+        # spectral lines closer than this are combined into one
+        self.min_dfreq = 1.0e-12
+        
+        # Ck spectrum
+        self.Ck = ckspectrum()
+        
+        # Response function samples at the last bias and spectrum lines
+        self.__Ires_cache__ = None
+        
+        # Number of threads used to calculate the spectra of each frequency
+        self.numThreads = 1
+        self.__pool__ = None
+        self.__poolSize__ = 0
          
         
     def __setSpectrum__(self):
         """Calculate spectrum by convolving spectra of each frequency"""
         
-        self.Ck = []
-        TempCk = []
-        TempOneCk = OneCk()
+        spectra = self.__frequencySpectra__()
         
         # Process 1st frequency
-        Tb = self.freqs[1].totalJ
+        f = self.freqs[1]
+        Ck = spectra[0]
+        Tb = (len(Ck)-1)//2
+        
+        freq = np.arange(-Tb, Tb+1)*f.Vph
+        Amp = Ck
+        
+        # Process additional frequencies, always in the same order
+        for f, Ck in zip(self.freqs[2:], spectra[1:]):
+            Tb = (len(Ck)-1)//2
+            
+            # Every combination of existing line and new Ck coefficient
+            freq = (freq[:, np.newaxis] \
+                        + np.arange(-Tb, Tb+1)*f.Vph).ravel()
+            Amp = (Amp[:, np.newaxis]*Ck).ravel()
+            
+            # Only keep Amp big enough to keep
+            keep = abs(Amp) > self.min_Ck
+            freq = freq[keep]
+            Amp = Amp[keep]
+            
+            if len(freq) == 0:
+                break
+            
+            # Sum the amplitudes of lines at the same frequency
+            order = np.argsort(freq, kind="mergesort")
+            freq = freq[order]
+            Amp = Amp[order]
+            start = np.concatenate(([0], \
+                        np.nonzero(np.diff(freq) > self.min_dfreq)[0] + 1))
+            freq = freq[start]
+            Amp = np.add.reduceat(Amp, start)
+            
+        self.Ck = ckspectrum(freq, Amp)
+            
+            
+    def __frequencySpectra__(self):
+        """
+        Returns list of the Ck arrays of each frequency.  If numThreads > 1
+        they are calculated concurrently on a thread pool; each frequency
+        locks its own coefficient caches, and the list is always in
+        frequency order
+        """
+        freqs = self.freqs[1:]
+        if (self.numThreads <= 1) or (len(freqs) <= 1):
+            return [f.getCk() for f in freqs]
+            
+        if (self.__pool__ is None) or (self.__poolSize__ != self.numThreads):
+            self.shutdown()
+            self.__pool__ = ThreadPoolExecutor(self.numThreads)
+            self.__poolSize__ = self.numThreads
+            
+        return list(self.__pool__.map(lambda f: f.getCk(), freqs))
         
-        for b in range(-Tb, Tb, 1):
-            TempOneCk.freq = b*self.freqs[1].Vph
-            TempOneCk.Amp = self.freqs[1].Cjk(b)
-            self.Ck.append(TempOneCk)
+        
+    def shutdown(self):
+        """Shuts down the thread pool, if any"""
+        if self.__pool__ is not None:
+            self.__pool__.shutdown()
+            self.__pool__ = None
+            
             
-        # Process additional frequencies
-        CkSize = len(self.Ck)
-        Added = FALSE
+    def addFrequency(self, f):
+        """Adds frequency object f.  Returns number of frequencies"""
+        self.freqs.append(f)
+        self.setHarmonicsToSolve()
+        
+        return len(self.freqs) - 1
+        
+        
+    def save_data(self, f):
+        """
+        Writes the multitone state, including its frequencies and response
+        function, out to file object (or filename) f in numpy .npz format
+        """
+        state = {"bias" : self.bias,
+                 "numJunctions" : self.numJunctions,
+                 "min_Ck" : self.min_Ck,
+                 "min_dfreq" : self.min_dfreq,
+                 "numFreqs" : len(self.freqs)-1,
+                 "Ck_freq" : self.Ck.freq,
+                 "Ck_Amp" : self.Ck.Amp}
         
-        for f in range(2, len(self.freqs), 1):
-            # Reset temporary variables
-            Tb = self.freqs[f].totalJ
-            TempCk = []
+        for n in range(1, len(self.freqs)):
+            for key, value in self.freqs[n].__get_arrays__().items():
+                state["freq%d.%s" % (n, key)] = value
                 
-            # Calculate each Ck coefficient
-            for b in range(-Tb, Tb, 1):
-                for k in range(CkSize):
-                    TempOneCk.Amp = Ck[k].Amp * self.freq[f].Cjk(b)
+        if self.response is not None:
+            for key, value in self.response.__get_arrays__().items():
+                state["response."+key] = value
+                
+        np.savez(f, version=SAVE_VERSION, **state)
+        
+        
+    def load_data(self, f):
+        """
+        Reads multitone state written by save_data from file object f.
+        Existing frequency and response function objects are reused where
+        possible.  The stored Vn can then be used to warm start a solution
+        """
+        with np.load(f) as data:
+            if int(data["version"]) != SAVE_VERSION:
+                raise ValueError("Unsupported save_data version %d" \
+                                    % int(data["version"]))
+                                    
+            self.bias = float(data["bias"])
+            if "numJunctions" in data.files:
+                self.numJunctions = int(data["numJunctions"])
+            self.min_Ck = float(data["min_Ck"])
+            self.min_dfreq = float(data["min_dfreq"])
+            self.Ck = ckspectrum(data["Ck_freq"], data["Ck_Amp"])
+            
+            numFreqs = int(data["numFreqs"])
+            del self.freqs[numFreqs+1:]
+            while len(self.freqs) <= numFreqs:
+                self.freqs.append(frequency.frequency())
+            for n in range(1, numFreqs+1):
+                self.freqs[n].__set_arrays__(data, "freq%d." % n)
+                
+            if "response.vdc" in data.files:
+                if self.response is None:
+                    self.response = responseFn.responseFn()
+                self.response.__set_arrays__(data, "response.")
+                
+        self.setHarmonicsToSolve()
+        
+        
+    def setHarmonicsToSolve(self):
+        """
+        Finds the harmonics with Z != 0, which are the unknowns of the
+        harmonic balance.  Must be called again if any Z is set to or from 0
+        """
+        self.freqsToSolve = []
+        self.harmsToSolve = []
+        for f in range(1, len(self.freqs)):
+            for h in range(1, self.freqs[f].getNumHarmonics()+1):
+                if self.freqs[f].Z[h] != 0.0:
+                    self.freqsToSolve.append(f)
+                    self.harmsToSolve.append(h)
                     
-                    # Check to see if Amp is big enough to keep
-                    if( abs(TempOneCk.Amp) > self.min_Ck ):
-                        Added = FALSE
-                        TempOneCk.freq = self.Ck[k].freq + b*self.freqs.Vph
-                        
-                        # If freq is already in Ck, add new value to old,
-                        # if not, add new value and freq to spectrum
-                        for c in TempCk:
-                            if abs(c.freq-TempOneCk.freq < DOUBLE_PRECISION):
-                                c.Amp += TempOneCk.Amp
-                                Added = TRUE
-                                break
-                        
-                        if (not Added):
-                            TempCk.append(TempOneCk)
-                            
-            self.Ck = TempCk
-            CkSize = len(self.Ck)
+        self.HarmonicSize = 2*len(self.freqsToSolve)
+        
+        
+    def __toSolve__(self, name):
+        """Returns array of attribute name (Vs, Z or Vn) of the harmonics to solve"""
+        return np.array([getattr(self.freqs[f], name)[h] for f, h in \
+                    zip(self.freqsToSolve, self.harmsToSolve)], dtype=complex)
+                    
+                    
+    def getVn(self):
+        """Returns array of Vn of the harmonics to solve"""
+        return self.__toSolve__("Vn")
+        
+        
+    def setVn(self, Vn):
+        """Sets Vn of the harmonics to solve from array Vn"""
+        for f, h, v in zip(self.freqsToSolve, self.harmsToSolve, Vn):
+            self.freqs[f].Vn[h] = complex(v)
             
             
-    def __Delta__(self, inX, outY):
-        """Calculate the Delta vector"""
+    def getJunctionVn(self):
+        """
+        Returns array of Vn of the harmonics to solve for every junction,
+        with one row per junction.  The rows are read only views of a single
+        junction's Vn, as the junctions are identical
+        """
+        Vn = self.getVn()
+        return np.broadcast_to(Vn, (self.numJunctions,) + Vn.shape)
+        
         
-        TempY = complex(1.0)
-        TempI = complex(1.0)
+    def getX(self):
+        """Returns Vn of the harmonics to solve as a real vector"""
+        X = np.empty(self.HarmonicSize)
+        Vn = self.getVn()
+        X[0::2] = Vn.real
+        X[1::2] = Vn.imag
+        return X
         
-        # Set Vn for each harmonic
-        for i in range(0, self.HarmonicSize, 2):
-            n = i/2 # We want this to truncate
-            self.freqs[freqsToSolve[n]].Vn[harmToSolve[n]] = \
-                                     complex(inX[i],inX[i+1])
-                                     
+        
+    def residual(self, Vn):
+        """
+        Calculates the harmonic balance residual Vs - Z*I - N*Vn for the
+        complex array Vn of junction voltages of the harmonics to solve,
+        where N is numJunctions.
+        Returns the residual array and its norm
+        """
+        Vn = np.asarray(Vn, dtype=complex)
+        self.setVn(Vn)
         self.__setSpectrum__()
         
-        # Calculate Delta
-        for i in range(0, self.HarmonicSize, 2):
-            n = i/2 # Again, we want truncation
-            TempI = self.HarmonicCurrent(self.freqsToSolve[n], self.harmsToSolve[n]);
-            TempY = self.freqs[self.freqsToSolve[n]].Vs[self.harmsToSolve[n]]
-            TempY -=self.freqs[self.freqsToSolve[n]].Z[self.harmsToSolve[n]]*TempI
-            TempY -=self.freqs[self.freqsToSolve[n]].Vn[self.harmsToSolve[n]]
-            outY[i] = TempY.real
-            outY[i+1] = TempY.imaginary
+        W = np.array([h*self.freqs[f].Vph for f, h in \
+                    zip(self.freqsToSolve, self.harmsToSolve)])
+        I = self.Ips(W)
+        
+        result = self.__toSolve__("Vs") - self.__toSolve__("Z")*I \
+                    - self.numJunctions*Vn
+        
+        return result, la.norm(result)
+        
+        
+    def __Delta__(self, inX, outY=None):
+        """
+        Calculate the Delta vector, the residual as a real vector of
+        interleaved real and imaginary parts.  inX holds Vn in the same
+        form.  Result is written into outY, if given, and returned, so
+        this can be passed directly to harmonicnewton or
+        scipy.optimize.root
+        """
+        inX = np.asarray(inX, dtype=float)
+        Y, norm = self.residual(inX[0::2] + 1j*inX[1::2])
+        
+        if outY is None:
+            outY = np.empty(len(inX))
+        outY[0::2] = Y.real
+        outY[1::2] = Y.imag
+        
+        return outY
             
 
     def HarmonicCurrent(self, freq, harm):
         """Return harm'th harmonic of freq'th frequency"""
-        f = harm*self.freqs[freq].Wph
+        f = harm*self.freqs[freq].Vph
         
         return self.Ip(f)
             
 
     def Ip(self, freq):
         """Return current flowing at frequency freq"""
+        return self.Ips([freq])[0]
+        
+        
+    def Ips(self, freqs):
+        """
+        Return array of currents flowing at each of the frequencies in
+        freqs, all calculated together from the current spectrum
+        """
+        W = np.asarray(freqs, dtype=float)
+        F = self.Ck.freq
+        C = self.Ck.Amp
+        
+        CIres = C*self.__Ires__()
+        
+        rs_plus = np.dot(self.__lookup__(F + W[:, np.newaxis]).conj(), CIres)
+        rs_minus = np.dot(self.__lookup__(F - W[:, np.newaxis]).conj(), CIres)
+        
+        result = rs_minus - rs_plus.conj()
+        result = np.where(W == 0.0, result/2.0, result)
+        
+        return result.imag + 1j*result.real
+        
+        
+    def getIp(self):
+        """
+        Returns array of currents at the harmonics to solve, followed by
+        the DC current, all from the current spectrum
+        """
+        W = np.array([h*self.freqs[f].Vph for f, h in \
+                    zip(self.freqsToSolve, self.harmsToSolve)] + [0.0])
+        return self.Ips(W)
+        
+        
+    def __Ires__(self):
+        """
+        Returns the response function at each line of the spectrum.  The
+        samples only depend on the response data, bias and line frequencies,
+        so are reused while these are unchanged, e.g. when only Vn or Z
+        change
+        """
+        F = self.Ck.freq
+        cache = self.__Ires_cache__
+        bias = self.bias/self.numJunctions
+        if (cache is not None) and (cache[0] is self.response) and \
+                (cache[1] == self.response.stamp) and (cache[2] == bias) \
+                and np.array_equal(cache[3], F):
+            return cache[4]
+            
+        V = bias + F
+        Ires = self.response.IkkArray(V) + 1j*self.response.IdcArray(V)
+        self.__Ires_cache__ = (self.response, self.response.stamp, bias, \
+                                F.copy(), Ires)
+        
+        return Ires
+        
+        
+    def sweepZ(self, Zs, omega=None, newton=None, max_it=50, tol=1.0e-8, \
+                    store=None, progress=None):
+        """
+        Solves the harmonic balance for each of a batch of embedding
+        impedances, with the LO and bias fixed.
+        Zs has one row per solution, giving Z of each harmonic to solve.  If
+        omega is given, each row of Zs instead tabulates Z at the normalised
+        frequencies omega, and is interpolated at every harmonic to solve.
+        Each solve is warm started from the converged solution with the
+        nearest Z.  Anp coefficients and response function samples are
+        reused between solves wherever they are unchanged.
+        newton is an optional harmonicnewton object carrying solver
+        settings; by default a damped Newton solver is used.  If store (a
+        resultstore) is given, solution i is stored at flat index i.  If
+        progress is given, progress(done, total) is called as each solve
+        completes, as for responseFn.progress.
+        Returns arrays of Vn, iteration counts and convergence flags, with
+        one row per row of Zs.  Z is restored afterwards
+        """
+        Zs = np.asarray(Zs, dtype=complex)
+        if omega is not None:
+            W = np.array([h*self.freqs[f].Vph for f, h in \
+                            zip(self.freqsToSolve, self.harmsToSolve)])
+            Zs = np.array([np.interp(W, omega, Z.real) \
+                            + 1j*np.interp(W, omega, Z.imag) for Z in Zs])
+        if (Zs.ndim != 2) or (Zs.shape[1] != len(self.freqsToSolve)):
+            raise ValueError("Zs must have one column for each of the %d " \
+                    "harmonics to solve" % len(self.freqsToSolve))
+                            
+        if newton is None:
+            newton = harmonicnewton.harmonicnewton(self.HarmonicSize)
+            newton.lineSearch = True
+        newton.function = self.__Delta__
+        
+        numZ = len(Zs)
+        Vn = np.zeros((numZ, len(self.freqsToSolve)), dtype=complex)
+        iterations = np.zeros(numZ, dtype=int)
+        converged = np.zeros(numZ, dtype=bool)
+        
+        oldZ = self.__toSolve__("Z")
+        startX = self.getX()
+        
+        try:
+            for i in range(numZ):
+                for f, h, z in zip(self.freqsToSolve, self.harmsToSolve, Zs[i]):
+                    self.freqs[f].Z[h] = complex(z)
+                    
+                # Warm start from the nearest Z solved so far
+                X = startX
+                if i > 0:
+                    distance = np.sum(abs(Zs[:i]-Zs[i])**2, axis=1)
+                    distance[~converged[:i]] = np.inf
+                    nearest = np.argmin(distance)
+                    if np.isfinite(distance[nearest]):
+                        X = np.empty(self.HarmonicSize)
+                        X[0::2] = Vn[nearest].real
+                        X[1::2] = Vn[nearest].imag
+                        
+                newton.setX(X)
+                iterations[i] = newton.Newton(max_it, tol)
+                converged[i] = newton.reason in ("step", "residual")
+                Vn[i] = newton.NewX[0::2] + 1j*newton.NewX[1::2]
+                
+                if store is not None:
+                    store.storeSolution(np.unravel_index(i, \
+                                store.data.shape), self, newton)
+                if progress is not None:
+                    progress(i+1, numZ)
+        finally:
+            for f, h, z in zip(self.freqsToSolve, self.harmsToSolve, oldZ):
+                self.freqs[f].Z[h] = z
+                
+        return Vn, iterations, converged
+        
+        
+    def __lookup__(self, freqs):
+        """
+        Returns Ck amplitudes at each of freqs, or zero where there is no
+        line in the spectrum
+        """
+        F = self.Ck.freq
+        if len(F) == 0:
+            return np.zeros(np.shape(freqs), dtype=complex)
+        
+        i = np.searchsorted(F, freqs - self.min_dfreq)
+        i = np.minimum(i, len(F)-1)
+        match = abs(F[i] - freqs) <= self.min_dfreq
         
-        
\ No newline at end of file
+        return np.where(match, self.Ck.Amp[i], 0.0)
@@ -0,0 +1,102 @@
+# noise.py
+#------------------------
+#
+# Defines a class calculating the shot noise current correlation matrix of
+# a pumped SIS junction from its Ck spectrum.
+#
+# For sidebands at w_m = w_IF + m*w_LO, with photon voltage Vph = hbar*w_LO/e
+# and Vif = hbar*w_IF/e,
+#
+#    H_mm' = sum_n C_(n-m) C*_(n-m') F(V0 + n*Vph + Vif)
+#          + sum_n C*_(n+m) C_(n+m') F(V0 + n*Vph - Vif)
+#
+# where F(V) = coth(eV/2kT) Idc(V), which is |Idc(V)| at zero temperature.
+# At zero temperature H_00 = 2 sum_n |C_n|^2 |Idc(V0 + n*Vph)|, which is
+# 2 Idc(pumped) only if every photon step with significant C_n has
+# V0 + n*Vph >= 0; otherwise H_00 is larger.  All quantities are normalised
+# as in responseFn, so H is in units of e*Igap.  The sums over n are matrix
+# products, evaluated for many bias points at once.
+#
+import numpy as np
+
+def fromFrequency(f, responseFn):
+    """Returns a noise object using the Ck spectrum of frequency object f"""
+    return noise(responseFn, f.getCk(), f.Vph)
+
+
+def fromMultitone(m, freq=1):
+    """
+    Returns a noise object using the Ck spectrum of multitone object m, with
+    sidebands of frequency m.freqs[freq].  All lines of the spectrum must be
+    harmonics of that frequency
+    """
+    Vph = m.freqs[freq].Vph
+    k = np.rint(m.Ck.freq/Vph).astype(int)
+    if np.any(abs(m.Ck.freq - k*Vph) > m.min_dfreq):
+        raise ValueError("Spectrum is not harmonic of frequency %d" % freq)
+
+    K = np.max(abs(k))
+    Ck = np.zeros(2*K+1, dtype=complex)
+    np.add.at(Ck, k+K, m.Ck.Amp)
+
+    return noise(m.response, Ck, Vph)
+
+
+class noise:
+    """Shot noise current correlation matrix of a pumped SIS junction"""
+    def __init__(self, responseFn, Ck, Vph):
+        """
+        Constructor takes:
+            responseFn : response function object of the junction
+            Ck : array of Ck for k in -K -> K
+            Vph : normalised photon voltage of the LO
+        """
+        self.response = responseFn
+        self.Ck = np.asarray(Ck, dtype=complex)
+        self.Vph = Vph
+
+        # Normalised temperature kT/eVgap.  Zero gives pure shot noise
+        self.temperature = 0.0
+
+
+    def F(self, V):
+        """Returns coth(V/2T)*Idc(V) for the array V"""
+        I = self.response.IdcArray(V)
+        t = self.temperature
+        if (t <= 0.0):
+            return abs(I)
+
+        # coth(V/2T)*Idc(V) -> 2T*dIdc/dV as V -> 0
+        small = abs(V) < 1.0e-9
+        x = np.where(small, 1.0, V)
+        slope = self.response.IdcArray(1.0e-6)/1.0e-6
+        return np.where(small, 2.0*t*slope, I/np.tanh(x/(2.0*t)))
+
+
+    def __C__(self, k):
+        """Returns Ck for the integer array k, zero outside of the spectrum"""
+        K = (len(self.Ck)-1)//2
+        inside = abs(k) <= K
+        return np.where(inside, self.Ck[np.clip(k+K, 0, 2*K)], 0.0)
+
+
+    def H(self, bias, sidebands=1, Vif=0.0):
+        """
+        Returns the current correlation matrix H_mm' for m, m' in
+        -sidebands -> sidebands, for each bias in the array bias.
+        The result has shape bias.shape + (2*sidebands+1, 2*sidebands+1)
+        """
+        bias = np.asarray(bias, dtype=float)
+        K = (len(self.Ck)-1)//2
+        m = np.arange(-sidebands, sidebands+1)
+        n = np.arange(-K-sidebands, K+sidebands+1)
+
+        A = self.__C__(n[np.newaxis, :] - m[:, np.newaxis])
+        B = self.__C__(n[np.newaxis, :] + m[:, np.newaxis])
+
+        V = bias[..., np.newaxis] + n*self.Vph
+        Fplus = self.F(V + Vif)
+        Fminus = self.F(V - Vif)
+
+        return np.einsum("mn,...n,ln->...ml", A, Fplus, A.conj()) \
+                + np.einsum("mn,...n,ln->...ml", B.conj(), Fminus, B)
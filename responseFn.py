@@ -7,8 +7,101 @@
 #
 # Derived from code by Phichet Kittara
 #
-import integrator, string
-from constants import pi
+import itertools
+import logging
+import numpy as np
+import integrator, surrogate
+from constants import pi, SAVE_VERSION
+
+logger = logging.getLogger(__name__)
+
+# Source of unique stamps identifying each version of the response data
+__stamps__ = itertools.count()
+
+
+def KK_matrix(u, bias):
+    """
+    Returns matrix W such that W.dot(g)/pi is the KK transform
+    P int g(u')/(u'-bias) du' / pi at each of the array of biases, for g
+    tabulated at the increasing abscissae u and linear between them.
+    The integral is exact for piecewise linear g, and covers u[0] -> u[-1]
+    """
+    u = np.asarray(u, dtype=float)
+    d = u[np.newaxis, :] - np.asarray(bias, dtype=float)[:, np.newaxis]
+    h = np.diff(u)
+    
+    # phi(x) = x ln|x|, with phi(0) = 0
+    absd = np.where(d == 0.0, 1.0, abs(d))
+    phi = d*np.log(absd)
+    
+    # For g linear on each interval,
+    # P int g/(u-b) = g_N (1 + ln|u_N-b|) - g_0 (1 + ln|u_0-b|)
+    #               - sum_j (g_(j+1)-g_j)/h_j (phi(u_(j+1)-b) - phi(u_j-b))
+    D = (phi[:, 1:] - phi[:, :-1])/h
+    W = np.zeros(d.shape)
+    W[:, :-1] += D
+    W[:, 1:] -= D
+    W[:, -1] += 1.0 + np.log(absd[:, -1])
+    W[:, 0] -= 1.0 + np.log(absd[:, 0])
+    
+    return W
+    
+    
+def family(vdc, idcs, Rn=1.0, yIntercept=0.0, vMax=10.0):
+    """
+    Returns a list of responseFn objects, one for each row of the 2-D array
+    idcs of DC IV curves tabulated at the bias values vdc (>= 0), which
+    extrapolate as yIntercept + Rn*|v|.
+    The KK transforms of all the curves are calculated together as one
+    matrix product, integrating the tabulated curve and vMax of the linear
+    extrapolation on either side.  The returned objects are views into
+    shared, read only arrays
+    """
+    vdc = np.array(vdc, dtype=float)
+    idcs = np.array(idcs, dtype=float, ndmin=2)
+    
+    # g = Idc - v is odd, so tabulate it over -v -> v, plus the linear
+    # extrapolation region
+    vTop = vdc[-1] + vMax
+    pos = np.concatenate((vdc[vdc > 0.0], [vTop]))
+    u = np.concatenate((-pos[::-1], [0.0], pos))
+    gTop = yIntercept + (Rn-1.0)*vTop
+    g = np.hstack((idcs[:, vdc > 0.0] - vdc[vdc > 0.0], \
+                   np.full((len(idcs), 1), gTop)))
+    g = np.hstack((-g[:, ::-1], np.zeros((len(idcs), 1)), g))
+    
+    ikks = np.dot(g, KK_matrix(u, vdc).T)/pi
+    
+    for table in (vdc, idcs, ikks):
+        table.flags.writeable = False
+        
+    views = []
+    for idc, ikk in zip(idcs, ikks):
+        r = responseFn()
+        r.__vdc__ = vdc
+        r.__idc__ = idc
+        r.__ikk__ = ikk
+        r.noPoints = len(vdc)
+        r.Rn = Rn
+        r.yIntercept = yIntercept
+        r.__KK_vMax__ = vMax
+        r.stamp = next(__stamps__)
+        views.append(r)
+        
+    return views
+    
+    
+def KennedyFamily(ns, maxBias=2.0, points=201):
+    """
+    Returns a list of responseFn objects holding Kennedy fit IV curves of
+    each order in ns, with their KK transforms all calculated together.
+    See responseFn.Kennedy and family
+    """
+    v = np.linspace(0.0, maxBias, points)
+    n = np.asarray(ns, dtype=float)[:, np.newaxis]
+    idcs = v**(2*n+1)/(1.0+v**(2*n))
+    
+    return family(v, idcs)
 
 class responseFn:
     """Class containing an SIS response function"""
@@ -22,13 +115,25 @@ class responseFn:
         self.yIntercept = 0.0
         self.noPoints = 201
         self.__bias__ = 0.0 # used in calculating the KK transform
-        self.__ikk__ = range(self.noPoints)
-        self.__idc__ = range(self.noPoints)
-        self.__vdc__ = range(self.noPoints)
+        self.__ikk__ = np.zeros(self.noPoints)
+        self.__idc__ = np.zeros(self.noPoints)
+        self.__vdc__ = np.zeros(self.noPoints)
         self.__Int__ = integrator.integrator()
         self.__Int__.__jMax__ = 12
         self.__KK_vMax__ = 10.0
         self.separator = "\t" # data value separator in idc and ikk files
+        # Optional callable progress(done, total), called as each point of
+        # a long calculation (e.g. the KK transform) completes
+        self.progress = None
+        # If smooth is set, cubic spline surrogates of the IV and KK curves
+        # are built whenever new data is loaded or generated
+        self.smooth = False
+        self.__idc_surrogate__ = None
+        self.__ikk_surrogate__ = None
+        # Unique value identifying the current data and surrogates.  It
+        # changes whenever either is replaced, so that samples cached
+        # elsewhere (e.g. by multitone) can be checked
+        self.stamp = next(__stamps__)
         
         
     def __bubbleFind__(self, testX, yList, xList, a, b):
@@ -45,7 +150,7 @@ class responseFn:
                                         /(xList[b]-xList[a])
                                         
         else: # Binary search until we just enclose the X value we want
-            c = a+(b-a)/2
+            c = a+(b-a)//2
             if( xList[c] < testX ): # New index is below required index
                 return self.__bubbleFind__(testX, yList, xList, c, b)
             else:
@@ -57,25 +162,97 @@ class responseFn:
         Returns the value of the KK transform at bias.
         If bias is outside of data range, returns final value of __ikk__
         """
+        if self.__ikk_surrogate__ is not None:
+            return self.__ikk_surrogate__(bias)
+        
         if (abs(bias) >= self.__vdc__[-1]): # Outside of bias data range
             return self.__ikk__[-1]
         else:
-            return self.__bubbleFind__(bias, self.__ikk__, self.__vdc__, \
-                                                0, len(self.__ikk__)-1)
+            return self.__bubbleFind__(abs(bias), self.__ikk__, \
+                                self.__vdc__, 0, len(self.__ikk__)-1)
         
         
     def Idc(self, bias):
         """Returns the DC current at bias"""
+        if self.__idc_surrogate__ is not None:
+            return self.__idc_surrogate__(bias)
+        
         if (abs(bias) > self.__vdc__[-1]): # Outside of bias data range
             result = self.yIntercept + self.Rn*abs(bias) # Linear extrapolation
         else:
-            result = self.__bubbleFind__(bias, self.__idc__, self.__vdc__, \
-                                                0, len(self.__idc__)-1)
+            result = self.__bubbleFind__(abs(bias), self.__idc__, \
+                                self.__vdc__, 0, len(self.__idc__)-1)
         if (bias < 0):
             result = -result
             
         return result
         
+        
+    def IkkArray(self, bias, deriv=0):
+        """
+        Returns the KK transform (or its deriv'th derivative) for an array
+        of bias values.  Derivatives need the surrogate, which is built if
+        necessary
+        """
+        if (self.__ikk_surrogate__ is None) and (deriv > 0):
+            self.makeSurrogate()
+        if self.__ikk_surrogate__ is not None:
+            return self.__ikk_surrogate__(bias, deriv)
+        
+        x = abs(np.asarray(bias, dtype=float))
+        return np.interp(x, self.__vdc__, self.__ikk__)
+        
+        
+    def IdcArray(self, bias, deriv=0):
+        """
+        Returns the DC current (or its deriv'th derivative) for an array of
+        bias values.  Derivatives need the surrogate, which is built if
+        necessary
+        """
+        if (self.__idc_surrogate__ is None) and (deriv > 0):
+            self.makeSurrogate()
+        if self.__idc_surrogate__ is not None:
+            return self.__idc_surrogate__(bias, deriv)
+        
+        bias = np.asarray(bias, dtype=float)
+        x = abs(bias)
+        result = np.where(x > self.__vdc__[-1], self.yIntercept + self.Rn*x, \
+                            np.interp(x, self.__vdc__, self.__idc__))
+        return np.where(bias < 0, -result, result)
+        
+        
+    def freeze(self):
+        """
+        Makes the IV and KK tables read only, so that one response function
+        can safely be shared, e.g. by every junction of a series array.
+        Loading or generating new data replaces the tables
+        """
+        self.__vdc__ = np.array(self.__vdc__, dtype=float)
+        self.__idc__ = np.array(self.__idc__, dtype=float)
+        self.__ikk__ = np.array(self.__ikk__, dtype=float)
+        for table in (self.__vdc__, self.__idc__, self.__ikk__):
+            table.flags.writeable = False
+                
+                
+    def makeSurrogate(self):
+        """
+        Builds cubic spline surrogates of the IV and KK curves.  Once built,
+        Idc, Ikk and the Array methods evaluate the surrogates
+        """
+        self.__idc_surrogate__ = surrogate.surrogate(self.__vdc__, \
+                self.__idc__, odd=True, intercept=self.yIntercept, \
+                slope=self.Rn)
+        self.__ikk_surrogate__ = surrogate.surrogate(self.__vdc__, \
+                self.__ikk__, odd=False, intercept=self.__ikk__[-1])
+        self.stamp = next(__stamps__)
+                
+                
+    def clearSurrogate(self):
+        """Discards the surrogates, reverting to interpolation of the tables"""
+        self.__idc_surrogate__ = None
+        self.__ikk_surrogate__ = None
+        self.stamp = next(__stamps__)
+        
              
     def Vdrive(self, n):
         """
@@ -103,7 +280,7 @@ class responseFn:
         idcV = []
         idcI = []
         for line in idcLines:
-            l = string.split(line, self.separator)
+            l = line.split(self.separator)
             try:
                 idcV.append(float(l[0]))
                 idcI.append(float(l[1]))
@@ -117,7 +294,7 @@ class responseFn:
         ikkV = []
         ikkI = []
         for line in ikkLines:
-            l = string.split(line, self.separator)
+            l = line.split(self.separator)
             try:
                 ikkV.append(float(l[0]))
                 ikkI.append(float(l[1]))
@@ -125,7 +302,7 @@ class responseFn:
                 continue
             
         # Match KK data to IV data
-        self.__ikk__ = range(len(self.__idc__))
+        self.__ikk__ = np.zeros(len(self.__idc__))
         for n in range(len(self.__vdc__)):
             v = self.__vdc__[n]
             self.__ikk__[n] = self.__bubbleFind__(v, ikkI, ikkV, 0, len(ikkV)-1)
@@ -160,6 +337,62 @@ class responseFn:
         self.Rn = Rn
         self.yIntercept = Imid - Vmid/self.Rn
         
+        self.clearSurrogate()
+        if self.smooth:
+            self.makeSurrogate()
+        
+        
+    def save_data(self, f):
+        """
+        Writes the response function out to file object (or filename) f, in
+        numpy .npz format.  The KK transform is saved, so load_data need not
+        recalculate it
+        """
+        np.savez(f, version=SAVE_VERSION, **self.__get_arrays__())
+        
+        
+    def load_data(self, f):
+        """Reads a response function written by save_data from file object f"""
+        with np.load(f) as data:
+            if int(data["version"]) != SAVE_VERSION:
+                raise ValueError("Unsupported save_data version %d" \
+                                    % int(data["version"]))
+            self.__set_arrays__(data)
+        
+        
+    def __get_arrays__(self):
+        """Private method returning dict of arrays describing the state"""
+        return {"Igap" : self.Igap,
+                "Vgap" : self.Vgap,
+                "Rn" : self.Rn,
+                "yIntercept" : self.yIntercept,
+                "KK_vMax" : self.__KK_vMax__,
+                "smooth" : self.smooth,
+                "vdc" : np.asarray(self.__vdc__, dtype=float),
+                "idc" : np.asarray(self.__idc__, dtype=float),
+                "ikk" : np.asarray(self.__ikk__, dtype=float)}
+                
+                
+    def __set_arrays__(self, state, prefix=""):
+        """
+        Private method restoring the state from a dict of arrays, with keys
+        optionally prefixed by prefix
+        """
+        self.Igap = float(state[prefix+"Igap"])
+        self.Vgap = float(state[prefix+"Vgap"])
+        self.Rn = float(state[prefix+"Rn"])
+        self.yIntercept = float(state[prefix+"yIntercept"])
+        self.__KK_vMax__ = float(state[prefix+"KK_vMax"])
+        self.smooth = bool(state[prefix+"smooth"])
+        self.__vdc__ = np.array(state[prefix+"vdc"])
+        self.__idc__ = np.array(state[prefix+"idc"])
+        self.__ikk__ = np.array(state[prefix+"ikk"])
+        self.noPoints = len(self.__vdc__)
+        
+        self.clearSurrogate()
+        if self.smooth:
+            self.makeSurrogate()
+        
         
     def Kennedy(self, n, maxBias=2.0, points=201):
         """
@@ -168,9 +401,9 @@ class responseFn:
         data.
         """
         # Clear and set length of data lists
-        self.__vdc__ = range(points)
-        self.__idc__ = range(points)
-        self.__ikk__ = range(points)
+        self.__vdc__ = np.zeros(points)
+        self.__idc__ = np.zeros(points)
+        self.__ikk__ = np.zeros(points)
         
         for k in range(points):
             v = maxBias * k / (points-1.0)
@@ -180,20 +413,45 @@ class responseFn:
         self.noPoints = points
         self.Rn = 1.0
         self.yIntercept = 0.0
+        
+        # A smooth IV curve lets the KK integrand be evaluated vectorized
+        self.clearSurrogate()
+        if self.smooth:
+            self.makeSurrogate()
         self.__calc_Ikk__()
+        if self.smooth:
+            self.makeSurrogate()
         
         
     def __calc_Ikk__(self):
-        """Calculates the KK transform of the current IV data"""
+        """
+        Calculates the KK transform of the current IV data.
+        Each point is logged at DEBUG level and reported to self.progress,
+        if set
+        """
+        debug = logger.isEnabledFor(logging.DEBUG)
+        self.__Int__.vectorized = self.__idc_surrogate__ is not None
         for i in range(self.noPoints):
             self.__bias__ = self.__vdc__[i]
             self.__ikk__[i] = self.__Int__.integrate(self.__KK_integrand__, \
                                     0.0, self.__KK_vMax__)/pi
-            print self.__bias__, ":", self.__ikk__[i]
+            if debug:
+                logger.debug("Ikk(%g) = %g", self.__bias__, self.__ikk__[i])
+            if self.progress is not None:
+                self.progress(i+1, self.noPoints)
+                
+        self.stamp = next(__stamps__)
 
                         
     def __KK_integrand__(self, v):
-        """Calculates the integrand used in the KK transform"""
-        G1 = (self.Idc(self.__bias__+v) - (self.__bias__+v)) / v
-        G2 = (self.Idc(self.__bias__-v) - (self.__bias__-v)) / (-v)
+        """
+        Calculates the integrand used in the KK transform.  v is an array
+        if the integrator is vectorized
+        """
+        if self.__Int__.vectorized:
+            Idc = self.IdcArray
+        else:
+            Idc = self.Idc
+        G1 = (Idc(self.__bias__+v) - (self.__bias__+v)) / v
+        G2 = (Idc(self.__bias__-v) - (self.__bias__-v)) / (-v)
         return G1+G2
\ No newline at end of file
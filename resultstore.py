@@ -0,0 +1,136 @@
+# resultstore.py
+#------------------------
+#
+# Defines a result store for sweeps over bias and LO power.
+#
+# Each solved operating point is written into a preallocated, memory mapped
+# numpy array on disk (a .npy file), so memory use does not grow with the
+# size of the sweep.  Rows are flushed to disk in chunks, and each row's
+# done flag is set last, so a partially completed map can be read with
+# load() while the sweep is still running.
+#
+import numpy as np
+
+def dtype(numHarmonics):
+    """Returns the record dtype for operating points with numHarmonics"""
+    return np.dtype([("bias", np.float64),
+                     ("pump", np.complex128),
+                     ("Vn", np.complex128, (numHarmonics,)),
+                     ("Ip", np.complex128, (numHarmonics,)),
+                     ("Idc", np.float64),
+                     ("iterations", np.int32),
+                     ("fevals", np.int32),
+                     ("converged", np.bool_),
+                     ("residual", np.float64),
+                     ("done", np.bool_)])
+
+
+def load(filename):
+    """
+    Opens a result store file read only.  Returns the memory mapped record
+    array; rows with done == False have not been written yet
+    """
+    return np.load(filename, mmap_mode="r")
+
+
+class resultstore:
+    """Memory mapped store of solved operating points"""
+    def __init__(self, filename, shape, numHarmonics=1, chunk=64, mode="w+"):
+        """
+        Constructor takes:
+            filename : .npy file to hold the results
+            shape : shape of the sweep grid, e.g. (numPump, numBias)
+            numHarmonics : number of harmonics solved at each point
+            chunk : number of points written between flushes
+            mode : "w+" to create a new store, "r+" to resume an existing one
+        """
+        if mode == "w+":
+            self.data = np.lib.format.open_memmap(filename, mode="w+", \
+                                dtype=dtype(numHarmonics), shape=shape)
+        else:
+            self.data = np.load(filename, mmap_mode=mode)
+
+        self.filename = filename
+        self.chunk = chunk
+        self.__unflushed__ = 0
+
+        # Next flat index used by append.  A resumed store carries on from
+        # the first point not yet written
+        remaining = np.flatnonzero(~self.data["done"].ravel())
+        if len(remaining):
+            self.next = int(remaining[0])
+        else:
+            self.next = self.data.size
+
+
+    def store(self, index, bias, Vn, Ip, Idc, pump=0.0, iterations=0, \
+                fevals=0, converged=False, residual=np.nan):
+        """
+        Writes an operating point at grid position index.  Points are only
+        marked converged if the caller says so; residual is NaN if unknown
+        """
+        row = self.data[index]
+        row["bias"] = bias
+        row["pump"] = pump
+        row["Vn"] = Vn
+        row["Ip"] = Ip
+        row["Idc"] = Idc
+        row["iterations"] = iterations
+        row["fevals"] = fevals
+        row["converged"] = converged
+        row["residual"] = residual
+        row["done"] = True
+
+        self.__unflushed__ += 1
+        if self.__unflushed__ >= self.chunk:
+            self.flush()
+
+
+    def append(self, *args, **kwargs):
+        """
+        Writes an operating point at the next grid position, in C order.
+        Takes the same arguments as store, less index.  Returns the index
+        """
+        index = np.unravel_index(self.next, self.data.shape)
+        self.store(index, *args, **kwargs)
+        self.next += 1
+
+        return index
+
+
+    def storeSolution(self, index, m, newton=None, pump=0.0):
+        """
+        Writes the operating point of multitone object m, solved by the
+        harmonicnewton object newton, at grid position index.  If index is
+        None the point is appended.  Without newton, the residual is
+        calculated from m and the point is not marked converged
+        """
+        if newton is None:
+            Y, norm = m.residual(m.getVn())
+            stats = {"residual" : norm}
+        else:
+            stats = {"iterations" : newton.iterations,
+                     "fevals" : newton.fevals,
+                     "converged" : newton.reason in ("step", "residual"),
+                     "residual" : np.linalg.norm(newton.NewY)}
+
+        I = m.getIp()
+
+        if index is None:
+            return self.append(m.bias, m.getVn(), I[:-1], I[-1].real, \
+                                pump=pump, **stats)
+        self.store(index, m.bias, m.getVn(), I[:-1], I[-1].real, \
+                        pump=pump, **stats)
+        return index
+
+
+    def flush(self):
+        """Writes any outstanding points to disk"""
+        self.data.flush()
+        self.__unflushed__ = 0
+
+
+    def close(self):
+        """Flushes and releases the memory map"""
+        self.flush()
+        del self.data
@@ -0,0 +1,89 @@
+# surrogate.py
+#------------------------
+#
+# Defines a smooth surrogate for tabulated response function curves
+#
+# The curve is tabulated for bias >= 0 and fitted with a cubic spline.
+# Negative bias is handled by symmetry (odd for the DC IV curve, even for
+# its KK transform), and bias beyond the table by linear extrapolation.
+# Evaluation is vectorized and the spline gives analytic derivatives.
+#
+import numpy as np
+from scipy.interpolate import CubicSpline
+
+class surrogate:
+    """Cubic spline surrogate of a tabulated response function curve"""
+    def __init__(self, v, y, odd=True, intercept=0.0, slope=0.0):
+        """
+        Constructor takes:
+            v : bias values of the table, for bias >= 0
+            y : curve values at v
+            odd : True if the curve is odd in bias, False if even
+            intercept, slope : curve is intercept + slope*|bias| beyond v
+        """
+        v = np.asarray(v, dtype=float)
+        y = np.asarray(y, dtype=float)
+        keep = v >= 0.0
+        v = v[keep]
+        y = y[keep]
+
+        self.odd = odd
+        self.intercept = intercept
+        self.slope = slope
+
+        self.__x__ = v
+        self.__vMax__ = v[-1]
+        # Polynomial coefficients on each interval, highest power first
+        self.__c__ = CubicSpline(v, y).c
+
+        # On a uniform grid the interval is found by division, giving
+        # constant evaluation cost per point
+        h = np.diff(v)
+        self.__uniform__ = np.allclose(h, h[0])
+        self.__h__ = h[0]
+
+
+    def __call__(self, bias, deriv=0):
+        """
+        Returns the curve (or its deriv'th derivative) at bias.  bias may be
+        a scalar or an array
+        """
+        scalar = np.ndim(bias) == 0
+        bias = np.atleast_1d(np.asarray(bias, dtype=float))
+        x = abs(bias)
+
+        # Find interval containing each point
+        if self.__uniform__:
+            i = ((x - self.__x__[0])/self.__h__).astype(int)
+        else:
+            i = np.searchsorted(self.__x__, x, side="right") - 1
+        i = np.clip(i, 0, self.__c__.shape[1]-1)
+        dx = x - self.__x__[i]
+
+        # Differentiate the cubic deriv times
+        c = self.__c__[:, i]
+        power = np.arange(3, -1, -1)
+        coeff = np.ones(4)
+        for d in range(deriv):
+            coeff *= np.maximum(power-d, 0)
+        result = np.zeros(x.shape)
+        for n in range(4-deriv):
+            result = result*dx + coeff[n]*c[n]
+
+        # Linear extrapolation beyond the table
+        outside = x > self.__vMax__
+        if np.any(outside):
+            if deriv == 0:
+                result[outside] = self.intercept + self.slope*x[outside]
+            elif deriv == 1:
+                result[outside] = self.slope
+            else:
+                result[outside] = 0.0
+
+        # Symmetry: d^n/dv^n of s^p*g(|v|) is s^(p+n)*g^(n)(|v|)
+        if (deriv + int(self.odd)) % 2 == 1:
+            result = np.where(bias < 0.0, -result, result)
+
+        if scalar:
+            return float(result[0])
+        return result
@@ -0,0 +1,322 @@
+# sweepservice.py
+#------------------------
+#
+# Defines a local sweep service, so that several users can share solved
+# operating points of the multitone/frequency/responseFn stack.
+#
+# Clients send sweep specifications as JSON lines over a local (unix)
+# socket.  Each operating point of a sweep is identified by a hash of
+# everything that determines its solution, with the bias rounded to
+# BIAS_DIGITS decimal places so that grids built by different arithmetic
+# still overlap.  Points found in the result store (an sqlite database) are
+# returned directly, points already being solved for another request are
+# waited for rather than solved twice, and the rest are solved on a pool of
+# worker processes.  Converged solutions are added to the store; points
+# that did not converge are solved again when next asked for.
+#
+# A sweep specification is a dict:
+#    iv : {"kennedy" : n, "maxBias" : 2.0, "points" : 201} or
+#         {"idc" : filename, "ikk" : filename}
+#    w0 : normalised LO frequency
+#    Vs, Z : lists of source voltage and embedding impedance of each
+#            harmonic of the LO, as [real, imag] pairs
+#    bias : list of normalised bias voltages
+#    numJunctions, max_it, tol : optional, defaults 1, 50, 1.0e-8
+# The reply is {"results" : [...]} with one result per bias, or
+# {"error" : message}.
+#
+# Start the service with
+#    python sweepservice.py --socket sweep.sock --store sweep.db
+#
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import multiprocessing
+import socket
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Version of the solver and result format, mixed into every key.  Increase
+# it when a change to either makes stored results stale
+VERSION = 1
+
+# Number of decimal places of bias that distinguish operating points
+BIAS_DIGITS = 12
+
+# Solver stacks already built in this (worker) process, keyed by setup key
+__stacks__ = {}
+
+
+def setup(spec):
+    """
+    Returns the part of a sweep specification shared by all its points, in
+    a normal form with defaults filled in, so that equivalent
+    specifications give the same keys
+    """
+    iv = spec["iv"]
+    if "kennedy" in iv:
+        iv = {"kennedy" : int(iv["kennedy"]),
+              "maxBias" : float(iv.get("maxBias", 2.0)),
+              "points" : int(iv.get("points", 201))}
+    elif "idc" in iv:
+        # Tabulated curves are identified by content; key leaves out the
+        # filenames
+        digest = hashlib.sha256()
+        for name in (iv["idc"], iv["ikk"]):
+            with open(name, "rb") as f:
+                digest.update(f.read())
+        iv = {"idc" : iv["idc"],
+              "ikk" : iv["ikk"],
+              "digest" : digest.hexdigest()}
+    else:
+        raise ValueError("iv must give either kennedy or idc and ikk")
+
+    return {"iv" : iv,
+            "w0" : float(spec["w0"]),
+            "Vs" : [[float(v[0]), float(v[1])] for v in spec["Vs"]],
+            "Z" : [[float(z[0]), float(z[1])] for z in spec["Z"]],
+            "numJunctions" : int(spec.get("numJunctions", 1)),
+            "max_it" : int(spec.get("max_it", 50)),
+            "tol" : float(spec.get("tol", 1.0e-8))}
+
+
+def key(setupSpec, bias=None):
+    """
+    Returns the hash identifying a setup, or one of its operating points.
+    bias should already be rounded to BIAS_DIGITS
+    """
+    iv = setupSpec["iv"]
+    if "digest" in iv:
+        setupSpec = dict(setupSpec, iv={"digest" : iv["digest"]})
+    text = json.dumps([VERSION, setupSpec, bias], sort_keys=True)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def __stack__(setupSpec):
+    """Returns the multitone object for setupSpec, building it if necessary"""
+    import frequency, responseFn, multitone
+
+    k = key(setupSpec)
+    if k in __stacks__:
+        return __stacks__[k]
+
+    iv = setupSpec["iv"]
+    r = responseFn.responseFn()
+    if "kennedy" in iv:
+        r = responseFn.KennedyFamily([iv["kennedy"]], iv["maxBias"], \
+                    iv["points"])[0]
+    else:
+        r.ReadData(iv["idc"], iv["ikk"])
+        r.freeze()
+
+    f = frequency.frequency()
+    f.setFrequency(setupSpec["w0"])
+    for n in range(1, len(setupSpec["Vs"])):
+        f.addHarmonic()
+    for n, (Vs, Z) in enumerate(zip(setupSpec["Vs"], setupSpec["Z"])):
+        f.setVs(n+1, complex(*Vs))
+        f.setZ(n+1, complex(*Z))
+
+    m = multitone.multitone()
+    m.response = r
+    m.numJunctions = setupSpec["numJunctions"]
+    m.addFrequency(f)
+
+    __stacks__[k] = m
+    return m
+
+
+def solve(setupSpec, bias):
+    """
+    Solves the operating point at bias for setupSpec.  Runs in a worker
+    process.  Returns a JSON serialisable dict of the solution
+    """
+    import numpy as np
+    import harmonicnewton
+
+    m = __stack__(setupSpec)
+    m.bias = bias
+    f = m.freqs[1]
+    for n, Vs in enumerate(setupSpec["Vs"]):
+        f.setVn(n+1, complex(*Vs)/m.numJunctions)
+
+    newton = harmonicnewton.harmonicnewton(m.HarmonicSize, m.__Delta__)
+    newton.lineSearch = True
+    newton.setX(m.getX())
+    newton.Newton(setupSpec["max_it"], setupSpec["tol"])
+
+    I = m.getIp()
+
+    return {"bias" : bias,
+            "Vn" : [[v.real, v.imag] for v in m.getVn()],
+            "Ip" : [[i.real, i.imag] for i in I[:-1]],
+            "Idc" : I[-1].real,
+            "iterations" : newton.iterations,
+            "fevals" : newton.fevals,
+            "converged" : newton.reason in ("step", "residual"),
+            "residual" : float(np.linalg.norm(newton.NewY))}
+
+
+class sweepservice:
+    """Local sweep service with de-duplication and a persistent store"""
+    def __init__(self, path, store, workers=None):
+        """
+        Constructor takes:
+            path : filename of the unix socket to listen on
+            store : filename of the sqlite result store
+            workers : number of worker processes, default one per core
+        """
+        self.path = path
+        # The store is only used from one thread, off the event loop
+        self.dbThread = ThreadPoolExecutor(1)
+        self.db = sqlite3.connect(store, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS results " \
+                            "(key TEXT PRIMARY KEY, result TEXT)")
+        self.db.commit()
+        # Spawned workers do not inherit the event loop, store or sockets
+        self.pool = ProcessPoolExecutor(workers, \
+                        mp_context=multiprocessing.get_context("spawn"))
+
+        # Futures of operating points being solved, keyed by point key
+        self.inFlight = {}
+
+        # Counts of points served from the store, from other requests and
+        # solved
+        self.stored = 0
+        self.shared = 0
+        self.solved = 0
+
+
+    def __lookup__(self, keys):
+        """Returns dict of the stored results for any of the point keys"""
+        keys = list(keys)
+        found = {}
+        # Stay well within sqlite's limit on query parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i+500]
+            rows = self.db.execute("SELECT key, result FROM results " \
+                        "WHERE key IN (%s)" % ",".join("?"*len(chunk)), chunk)
+            for k, result in rows:
+                found[k] = json.loads(result)
+        return found
+
+
+    def __insert__(self, k, result):
+        """Stores result under point key k"""
+        self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?)", \
+                            (k, json.dumps(result)))
+        self.db.commit()
+
+
+    async def point(self, setupSpec, bias, k):
+        """
+        Returns the result for one operating point with key k, that is not
+        in the store
+        """
+        if k in self.inFlight:
+            self.shared += 1
+            return await asyncio.shield(self.inFlight[k])
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self.pool, solve, setupSpec, bias)
+        self.inFlight[k] = future
+        try:
+            result = await future
+            if result["converged"]:
+                await loop.run_in_executor(self.dbThread, self.__insert__, \
+                                            k, result)
+            self.solved += 1
+        finally:
+            del self.inFlight[k]
+
+        return result
+
+
+    async def sweep(self, spec):
+        """Returns the results for every bias of a sweep specification"""
+        setupSpec = setup(spec)
+        biases = [round(float(b), BIAS_DIGITS) for b in spec["bias"]]
+        keys = [key(setupSpec, b) for b in biases]
+
+        # One store lookup for the whole sweep
+        loop = asyncio.get_running_loop()
+        found = await loop.run_in_executor(self.dbThread, self.__lookup__, \
+                                            set(keys))
+        self.stored += len([k for k in keys if k in found])
+
+        return await asyncio.gather(*[self.__result__(found, setupSpec, b, k) \
+                                        for b, k in zip(biases, keys)])
+
+
+    async def __result__(self, found, setupSpec, bias, k):
+        """Returns the result for key k from found, or by solving it"""
+        if k in found:
+            return found[k]
+        return await self.point(setupSpec, bias, k)
+
+
+    async def __handle__(self, reader, writer):
+        """Serves the requests on one client connection"""
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                reply = {"results" : await self.sweep(json.loads(line))}
+            except Exception as e:
+                logger.exception("Sweep request failed")
+                reply = {"error" : str(e)}
+            writer.write((json.dumps(reply) + "\n").encode("utf-8"))
+            await writer.drain()
+        writer.close()
+
+
+    async def serve(self):
+        """Listens on the socket until cancelled"""
+        server = await asyncio.start_unix_server(self.__handle__, self.path)
+        async with server:
+            await server.serve_forever()
+
+
+    def close(self):
+        """Shuts down the workers and closes the store"""
+        self.pool.shutdown()
+        self.dbThread.shutdown()
+        self.db.close()
+
+
+def submit(spec, path):
+    """
+    Client helper: sends sweep specification spec to the service listening
+    on path, and returns its list of results
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall((json.dumps(spec) + "\n").encode("utf-8"))
+        with s.makefile("rb") as f:
+            reply = json.loads(f.readline())
+
+    if "error" in reply:
+        raise RuntimeError(reply["error"])
+    return reply["results"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local sweep service")
+    parser.add_argument("--socket", default="sweep.sock")
+    parser.add_argument("--store", default="sweep.db")
+    parser.add_argument("--workers", type=int, default=None)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    service = sweepservice(args.socket, args.store, args.workers)
+    try:
+        asyncio.run(service.serve())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()